@@ -1,12 +1,15 @@
 #!/bin/python3
 
 import argparse
+import gc
 import json
 import os
+import resource
 import subprocess
 import threading
+import tracemalloc
 import webbrowser
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import cairo
 import gi
@@ -43,6 +46,15 @@ FADE_IN_STEP = 0.05
 FADE_OUT_STEP = 0.05
 FADE_DELTA = 10
 DISCARD_INACTIVE_WORKSPACE = False
+PROFILE_MEMORY = False
+PROFILE_INTERVAL = 60
+PROFILE_TOP = 10
+SOAK_EVENTS = 0
+SOAK_MAX_GROWTH = 1024
+SOAK_MAX_RSS_GROWTH = 10240
+SOAK_UNCACHED_EVENTS = 1000
+SOAK_WARMUP_EVENTS = 1000
+SOAK_MIN_EVENTS = 2 * SOAK_WARMUP_EVENTS
 
 def set_border_rgba(args):
     args.border_rgba = args.border_rgba.replace("0x", "#") # Handle both hex formats
@@ -189,6 +201,36 @@ def get_args():
         action='store_true',
         help="Discard all borders not in the active workspace, may improve performance with a large amount of windows."
     )
+    parser.add_argument(
+        "--profile-memory",
+        default=False,
+        action='store_true',
+        help="Periodically print the top memory growth sites, the RSS trend and the Wnck window references held."
+    )
+    parser.add_argument(
+        "--profile-interval",
+        default=60,
+        type=int,
+        help="The time between memory profile reports, in seconds."
+    )
+    parser.add_argument(
+        "--soak-events",
+        default=0,
+        type=int,
+        help="Run this many synthetic focus/geometry events against the open windows, report memory growth and exit."
+    )
+    parser.add_argument(
+        "--soak-max-growth",
+        default=1024,
+        type=int,
+        help="The python memory growth allowed during a soak run, in KiB. The soak run exits with an error above it."
+    )
+    parser.add_argument(
+        "--soak-max-rss-growth",
+        default=10240,
+        type=int,
+        help="The RSS growth allowed during a soak run, in KiB. The soak run exits with an error above it."
+    )
     parser.add_argument(
         "--version",
         action="store_true",
@@ -233,6 +275,11 @@ def get_args():
     global FADE_OUT_STEP
     global FADE_DELTA
     global DISCARD_INACTIVE_WORKSPACE
+    global PROFILE_MEMORY
+    global PROFILE_INTERVAL
+    global SOAK_EVENTS
+    global SOAK_MAX_GROWTH
+    global SOAK_MAX_RSS_GROWTH
 
     BORDER_RADIUS = args.border_radius
     BORDER_WIDTH = args.border_width
@@ -251,6 +298,11 @@ def get_args():
     FADE = args.fade
     FADE_DELTA = args.fade_delta
     DISCARD_INACTIVE_WORKSPACE = args.discard_inactive_workspace
+    PROFILE_MEMORY = args.profile_memory
+    PROFILE_INTERVAL = args.profile_interval
+    SOAK_EVENTS = args.soak_events
+    SOAK_MAX_GROWTH = args.soak_max_growth
+    SOAK_MAX_RSS_GROWTH = args.soak_max_rss_growth
 
     if BORDER_A == 0:
         print("Invisible border, exiting.")
@@ -268,6 +320,13 @@ def get_args():
         raise ValueError(
             f"Invalid border_mode: '{args.border_mode}'. Valid border_modes are: inside, outside and center.")
 
+    if PROFILE_INTERVAL <= 0:
+        raise ValueError(f"Invalid profile_interval: '{PROFILE_INTERVAL}'. It must be at least 1 second.")
+    if SOAK_EVENTS < 0 or 0 < SOAK_EVENTS < SOAK_MIN_EVENTS:
+        raise ValueError(f"Invalid soak_events: '{SOAK_EVENTS}'. It must be 0 or at least {SOAK_MIN_EVENTS}.")
+    if SOAK_MAX_GROWTH < 0 or SOAK_MAX_RSS_GROWTH < 0:
+        raise ValueError("Invalid soak_max_growth or soak_max_rss_growth: memory growth limits can't be negative.")
+
     return
 
 
@@ -306,7 +365,7 @@ def notify_about_version(latest_version: float):
 
 
 def notify_version():
-    if NO_VERSION_NOTIFY:
+    if NO_VERSION_NOTIFY or SOAK_EVENTS > 0: # Soak runs are scripted, don't hit the network or notify
         return
     try:
         our_location = os.path.dirname(os.path.abspath(__file__))
@@ -348,6 +407,8 @@ def get_wm_state(xid):
             
     except Exception as e:
         return f"Error retrieving WM_STATE: {e}"
+    finally:
+        d.close() # Every call opens a new connection to the X server, don't leak it
 
 class Highlight(Gtk.Window):
     def __init__(self, screen_width, screen_height):
@@ -420,10 +481,20 @@ class Highlight(Gtk.Window):
     old_window = None
     old_signals_to_disconnect = defaultdict(list)
 
+    # Soak runs set this to a dict, the WM_STATE of their fixed windows doesn't change.
+    wm_state_cache = None
+
+    def get_wm_state(self, xid):
+        if self.wm_state_cache is None:
+            return get_wm_state(xid)
+        if xid not in self.wm_state_cache:
+            self.wm_state_cache[xid] = get_wm_state(xid)
+        return self.wm_state_cache[xid]
+
     def is_alone_in_workspace(self):
-        workspace = Wnck.Screen.get_active_workspace(self.wnck_screen)
-        windows = Wnck.Screen.get_windows(self.wnck_screen)
-        windows_on_workspace = list(filter(lambda w: w.is_visible_on_workspace(workspace) and get_wm_state(w.get_xid()) == "normal", windows))
+        workspace = self.wnck_screen.get_active_workspace()
+        windows = self.wnck_screen.get_windows()
+        windows_on_workspace = list(filter(lambda w: w.is_visible_on_workspace(workspace) and self.get_wm_state(w.get_xid()) == "normal", windows))
         return len(windows_on_workspace) == 1
 
     # This event will trigger every active window change, it will queue a border to be drawn and then do nothing.
@@ -644,24 +715,204 @@ class Highlight(Gtk.Window):
         ctx.restore()
         self.borders = {xid: border for xid, border in self.borders.items() if border["alpha"] or border["fade"]}
 
+def get_rss_kib():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * resource.getpagesize() // 1024
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # Peak, not current, but better than nothing
+
+
+def take_snapshot():
+    # Ignore the memory used by earlier snapshots, we keep some of them around to compare against
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+
+class MemoryProfiler:
+    # Only soak runs need the first snapshot, we don't want to hold onto it for weeks otherwise.
+    def __init__(self, highlight, keep_first_snapshot=False):
+        self.highlight = highlight
+        self.samples = 0
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.last_snapshot = take_snapshot()
+        self.first_snapshot = self.last_snapshot if keep_first_snapshot else None
+        self.first_rss = get_rss_kib()
+        self.rss_trend = deque([self.first_rss], maxlen=10)
+
+    # Counts the Wnck windows we keep alive through signal handlers or borders, and the handlers actually connected
+    # to them. A handler still connected after its id left `old_signals_to_disconnect` can never be disconnected,
+    # so it is counted as untracked. `__grefcount__` includes the reference held by the python wrapper itself.
+    def count_wnck_references(self):
+        signals_to_disconnect = self.highlight.old_signals_to_disconnect
+        xids = set(self.highlight.borders.keys())
+        xids.update(xid for xid, sig_ids in signals_to_disconnect.items() if sig_ids)
+
+        refs = 0
+        for xid in xids:
+            window = Wnck.Window.get(xid)
+            if window is not None:
+                refs += window.__grefcount__
+
+        connected = 0
+        untracked = 0
+        for window in self.highlight.wnck_screen.get_windows():
+            window_connected = 0
+            for signal in ["geometry-changed", "state-changed"]:
+                signal_id = GObject.signal_lookup(signal, window)
+                if GObject.signal_has_handler_pending(window, signal_id, 0, False):
+                    window_connected += 1
+            connected += window_connected
+            untracked += max(window_connected - len(signals_to_disconnect.get(window.get_xid()) or []), 0)
+
+        return len(xids), connected, untracked, refs
+
+    def sample(self):
+        gc.collect()
+        self.samples += 1
+        snapshot = take_snapshot()
+        rss = get_rss_kib()
+        self.rss_trend.append(rss)
+        traced, peak = tracemalloc.get_traced_memory()
+        windows, handlers, untracked, refs = self.count_wnck_references()
+
+        print(f"[profile-memory] sample {self.samples}: rss {rss} KiB "
+              f"({rss - self.first_rss:+d} KiB since start, {rss - self.rss_trend[-2]:+d} KiB since last), "
+              f"traced {traced // 1024} KiB (peak {peak // 1024} KiB)")
+        print(f"[profile-memory] rss trend (KiB): {' '.join(str(r) for r in self.rss_trend)}")
+        print(f"[profile-memory] wnck windows held: {windows}, signal handlers connected: {handlers} "
+              f"({untracked} untracked), gobject refs: {refs}")
+
+        growth = [stat for stat in snapshot.compare_to(self.last_snapshot, "lineno") if stat.size_diff > 0]
+        if growth:
+            print("[profile-memory] top growth sites since last sample:")
+            for stat in growth[:PROFILE_TOP]:
+                print(f"    {stat}")
+
+        self.last_snapshot = snapshot
+        return True # Keep the GLib timeout alive
+
+    def traced_growth(self):
+        gc.collect()
+        snapshot = take_snapshot()
+        return sum(stat.size_diff for stat in snapshot.compare_to(self.first_snapshot, "filename"))
+
+
+# Stands in for the Wnck screen during a soak run, so we can choose the active window ourselves instead of
+# waiting for the window manager to change focus. Everything else is forwarded to the real screen.
+class SoakScreen:
+    def __init__(self, screen):
+        self.screen = screen
+        self.active_window = None
+
+    def get_active_window(self):
+        return self.active_window
+
+    def __getattr__(self, name):
+        return getattr(self.screen, name)
+
+
+def run_soak(highlight):
+    highlight.wnck_screen.force_update()
+    windows = highlight.wnck_screen.get_windows()
+    if not windows:
+        print("ERROR: soak run needs at least one open window.")
+        return 1
+
+    # Without the cache every focus event opens an X connection per window, which costs far more than the handlers
+    # we want to measure. The last sample runs without it, so a leaked connection still shows up in the RSS.
+    highlight.wm_state_cache = {}
+
+    soak_screen = SoakScreen(highlight.wnck_screen)
+    highlight.wnck_screen = soak_screen
+    context = GLib.MainContext.default()
+
+    def run_events(start, stop):
+        for i in range(start, stop):
+            if i % 2 == 0:
+                soak_screen.active_window = windows[(i // 2) % len(windows)]
+                highlight._active_window_changed_event(soak_screen, None)
+            else:
+                highlight._geometry_changed_event(soak_screen.active_window)
+
+            if i % 100 == 0: # Let the draws and fade timeouts run like they would in Gtk.main
+                while context.iteration(False):
+                    pass
+
+    # Warm up first, the first events allocate caches and wrappers that are never freed by design.
+    # get_args makes sure at least half of the events are left to measure.
+    warmup = max(SOAK_EVENTS // 100, SOAK_WARMUP_EVENTS)
+    run_events(0, warmup)
+
+    profiler = MemoryProfiler(highlight, keep_first_snapshot=True)
+    checkpoints = 10
+    step = (SOAK_EVENTS - warmup) // checkpoints
+    for start in range(warmup, SOAK_EVENTS, step):
+        run_events(start, min(start + step, SOAK_EVENTS))
+        profiler.sample()
+
+    highlight.wm_state_cache = None
+    run_events(SOAK_EVENTS, SOAK_EVENTS + SOAK_UNCACHED_EVENTS)
+    profiler.sample()
+
+    growth = profiler.traced_growth() // 1024
+    rss_growth = profiler.rss_trend[-1] - profiler.first_rss
+    held_windows, handlers, untracked, refs = profiler.count_wnck_references()
+    print(f"soak: {SOAK_EVENTS} events ({SOAK_UNCACHED_EVENTS} more without the WM_STATE cache) over {len(windows)} windows, "
+          f"traced growth {growth} KiB (limit {SOAK_MAX_GROWTH} KiB), "
+          f"rss growth {rss_growth} KiB (limit {SOAK_MAX_RSS_GROWTH} KiB), "
+          f"wnck windows held: {held_windows}, signal handlers connected: {handlers} ({untracked} untracked), "
+          f"gobject refs: {refs}")
+
+    failed = False
+    if growth > SOAK_MAX_GROWTH:
+        print("ERROR: soak run exceeded the python memory growth limit!")
+        failed = True
+    if rss_growth > SOAK_MAX_RSS_GROWTH:
+        print("ERROR: soak run exceeded the RSS growth limit!")
+        failed = True
+    # The window set is fixed, so we should never hold more than a geometry and a state handler per window,
+    # and every connected handler must still be known so it can be disconnected.
+    if held_windows > len(windows) or handlers > 2 * len(windows) or untracked > 0:
+        print("ERROR: soak run leaked Wnck windows or signal handlers!")
+        failed = True
+    return 1 if failed else 0
+
 
 def main():
     get_args()
+
+    # Soak runs are usually started on a desktop where xborders is already running, they don't touch its state
+    # so they get their own lock.
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    lock = zc.lockfile.LockFile(os.path.join(script_dir, '.soak.lock' if SOAK_EVENTS > 0 else '.lock'))
+
     root = Gdk.get_default_root_window()
     root.get_screen()
     screen_width, screen_height = get_screen_size(Gdk.Display.get_default())
-    Highlight(screen_width, screen_height)
+    highlight = Highlight(screen_width, screen_height)
+
+    if SOAK_EVENTS > 0:
+        exit(run_soak(highlight))
+
+    if PROFILE_MEMORY:
+        profiler = MemoryProfiler(highlight)
+        GLib.timeout_add_seconds(PROFILE_INTERVAL, profiler.sample)
+
     Gtk.main()
 
 
 if __name__ in  ["__main__", "xborders.main", "src.xborders.main"]:
     try:
-        script_dir = os.path.dirname(os.path.realpath(__file__))
-        lock = zc.lockfile.LockFile(os.path.join(script_dir, '.lock'))
         main()
     except KeyboardInterrupt:
         exit(0)
     except zc.lockfile.LockError:
+        if SOAK_EVENTS > 0:
+            print("ERROR: a soak run is already running!")
+            exit(1) # A skipped soak run must not look like a pass
         print("ERROR: xborders is already running!")
         exit(0)
 else: